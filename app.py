@@ -7,19 +7,32 @@ Built for SDLC/DevOps coursework. Kept intentionally small and readable,
 with a simple three-layer split: templates (presentation), routes/controllers
 (application), and SQLAlchemy + SQLite (data).
 """
+import atexit
 from datetime import datetime
-from flask import Flask, render_template, request, redirect, url_for, flash, abort, Blueprint, g, jsonify
+import gzip
+import json
+import jinja2
+from flask import Flask, render_template, request, redirect, url_for, flash, abort, Blueprint, g, jsonify, current_app
+from flask_caching import Cache
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import inspect
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, raiseload
+from sqlalchemy.schema import CreateTable
 import os
+import queue
+import sqlite3
+import threading
 from typing import Any, Optional
 from time import perf_counter
-from prometheus_client import Counter, generate_latest
+from prometheus_client import Counter, Histogram, generate_latest
 
 db = SQLAlchemy()
+cache = Cache()
 
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 DB_PATH = os.path.join(BASE_DIR, 'blog.db')
+JINJA_CACHE_DIR = os.path.join(BASE_DIR, '.jinja_cache')
 
 
 
@@ -28,16 +41,40 @@ class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY', 'dev-secret-key')
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', f'sqlite:///{DB_PATH}')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # File-backed SQLite already gets a QueuePool (5 + 10 overflow) in SQLAlchemy 2.x;
+    # keep connections warm, drop dead ones, and wait on locks instead of failing fast.
+    SQLALCHEMY_ENGINE_OPTIONS = {"pool_pre_ping": True}
+    if SQLALCHEMY_DATABASE_URI.startswith('sqlite'):
+        SQLALCHEMY_ENGINE_OPTIONS["connect_args"] = {"check_same_thread": False, "timeout": 30}
+    CACHE_TYPE = 'SimpleCache'
+    # Write audit entries from a background thread in batches (see log_action).
+    ACTION_LOG_ASYNC = True
+
+
+@event.listens_for(Engine, "connect")
+def _sqlite_pragmas(dbapi_conn, _conn_record):
+    """Use WAL + NORMAL sync on SQLite: fewer fsyncs, readers don't block on writers."""
+    if not isinstance(dbapi_conn, sqlite3.Connection):
+        return
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA mmap_size=268435456")
+    cur.close()
 
 bp = Blueprint("main", __name__)
 
 # Prometheus metrics
 REQUEST_COUNT = Counter("request_count", "Total requests", ["endpoint"])
 
-# In-memory metrics used for /health JSON
-REQUEST_TOTAL = 0          # plain integer counter
-ERROR_COUNT = 0
-TOTAL_LATENCY = 0.0
+# Totals also summarised by /health (thread-safe, unlike plain globals)
+REQ_TOTAL = Counter("requests", "Total requests handled")
+ERR_TOTAL = Counter("request_errors", "Requests that raised an unhandled exception")
+LATENCY = Histogram("request_latency_seconds", "Request latency in seconds")
+
+# Polled by probes/scrapers; kept out of the metrics they report on.
+MONITORING_PATHS = frozenset({"/health", "/metrics"})
 
 # ----------------------
 # Models
@@ -52,13 +89,17 @@ class Post(db.Model):
     Archived posts are hidden from the public homepage.
     """
     __tablename__ = 'posts'
+    # Serves the public homepage query (non-archived, newest first) without a sort.
+    __table_args__ = (db.Index('ix_posts_archived_created', 'is_archived', 'created_at'),)
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200), nullable=False)
     content = db.Column(db.Text, nullable=False)
     is_archived = db.Column(db.Boolean, default=False, nullable=False)
     # Note: naive UTC for simplicity; in production you'd likely use timezone-aware timestamps.
-    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+    # Filled in by the database (SQLite's CURRENT_TIMESTAMP is UTC, second precision).
+    created_at = db.Column(db.DateTime, server_default=db.func.current_timestamp(), nullable=False)
+    updated_at = db.Column(db.DateTime, server_default=db.func.current_timestamp(),
+                           onupdate=db.func.current_timestamp(), nullable=False)
 
     def __repr__(self):
         return f"<Post {self.id} {self.title!r}>"
@@ -77,11 +118,13 @@ class ActionLog(db.Model):
         self.post_id = post_id
         self.note = note
     __tablename__ = 'action_logs'
+    # Serves the history page (newest first, limit 200).
+    __table_args__ = (db.Index('ix_action_logs_created', 'created_at'),)
     id = db.Column(db.Integer, primary_key=True)
     action = db.Column(db.String(100), nullable=False)
     post_id = db.Column(db.Integer, db.ForeignKey('posts.id'), nullable=True)
     note = db.Column(db.Text, nullable=True)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    created_at = db.Column(db.DateTime, server_default=db.func.current_timestamp(), nullable=False)
 
     post = db.relationship('Post', backref=db.backref('logs', lazy=True))
 
@@ -92,30 +135,159 @@ class ActionLog(db.Model):
 # Utility: log actions
 # ----------------------
 
+ACTION_LOG_QUEUE_SIZE = 10_000
+ACTION_LOG_BATCH_SIZE = 200
+ACTION_LOG_MAX_WAIT = 0.05  # seconds to wait for a batch to fill up
+
+def _action_log_queue() -> queue.Queue | None:
+    """The background writer's queue, or None if there is no live writer to drain it.
+
+    The thread can be missing in this process even though the queue exists,
+    e.g. when a pre-forking server (gunicorn --preload) forked after startup.
+    """
+    writer = current_app.extensions.get("action_log_writer")
+    if writer is None:
+        return None
+    log_q, worker = writer
+    return log_q if worker.is_alive() else None
+
 def log_action(action: str, post: Post | None = None, note: str | None = None):
-    """Append an audit entry to action_logs.
+    """Record an audit entry for the change about to be committed.
+
+    With ACTION_LOG_ASYNC the entry is held on the session and handed to the
+    background writer only once the caller's commit succeeds, so the request
+    doesn't wait on the insert and a failed commit leaves no audit row.
+    Otherwise (or with no live writer) it is staged in the current session
+    and the caller's commit writes it together with the change being logged.
 
     Args:
         action: One of CREATE/UPDATE/DELETE/ARCHIVE/UNARCHIVE.
         post: The Post affected (None for DELETE after removal).
         note: Short human-readable context.
     """
-    entry = ActionLog(action=action, post_id=(post.id if post else None), note=note)
-    db.session.add(entry)
-    db.session.commit()
+    entry = {
+        "action": action,
+        "post_id": post.id if post else None,
+        "note": note,
+    }
+    if _action_log_queue() is not None:
+        # Stamp now: the batch may be written a little after the action happened.
+        db.session.info.setdefault("pending_action_logs", []).append(
+            {**entry, "created_at": datetime.utcnow()}
+        )
+        return
+    # Core insert: a fire-and-forget row doesn't need ORM identity/flush bookkeeping.
+    db.session.execute(ActionLog.__table__.insert().values(**entry))
+
+@event.listens_for(Session, "after_commit")
+def _enqueue_committed_action_logs(session):
+    """Hand audit entries held by log_action() to the background writer."""
+    pending = session.info.pop("pending_action_logs", None)
+    if not pending:
+        return
+    log_q = _action_log_queue()
+    overflow = []
+    for entry in pending:
+        if log_q is not None:
+            try:
+                log_q.put_nowait(entry)
+                continue
+            except queue.Full:
+                pass
+        overflow.append(entry)
+    if overflow:
+        # The session is mid-commit and can't emit SQL; write these on their own.
+        with db.engine.begin() as conn:
+            conn.execute(ActionLog.__table__.insert(), overflow)
+        invalidate_history()
+
+@event.listens_for(Session, "after_rollback")
+def _discard_pending_action_logs(session):
+    """Drop held audit entries whose change was rolled back."""
+    session.info.pop("pending_action_logs", None)
+
+def _action_log_worker(app: Flask, log_q: queue.Queue) -> None:
+    """Drain queued audit entries, inserting up to ACTION_LOG_BATCH_SIZE per transaction.
+
+    A None on the queue flushes what has been collected and stops the worker.
+    """
+    stopping = False
+    while not stopping:
+        batch = []
+        entry = log_q.get()
+        deadline = perf_counter() + ACTION_LOG_MAX_WAIT
+        while entry is not None:
+            batch.append(entry)
+            remaining = deadline - perf_counter()
+            if len(batch) >= ACTION_LOG_BATCH_SIZE or remaining <= 0:
+                break
+            try:
+                entry = log_q.get(timeout=remaining)
+            except queue.Empty:
+                break
+        stopping = entry is None
+        if not batch:
+            continue
+        with app.app_context():
+            try:
+                with db.engine.begin() as conn:
+                    conn.execute(ActionLog.__table__.insert(), batch)
+                invalidate_history()
+            except Exception:
+                app.logger.exception("Failed to write %d action log entries", len(batch))
+
+def _start_action_log_worker(app: Flask) -> None:
+    """Start the background audit writer for this app and stop it cleanly at exit."""
+    log_q: queue.Queue = queue.Queue(maxsize=ACTION_LOG_QUEUE_SIZE)
+    worker = threading.Thread(target=_action_log_worker, args=(app, log_q),
+                              name="action-log-writer", daemon=True)
+    worker.start()
+    app.extensions["action_log_writer"] = (log_q, worker)
+
+    def _stop():
+        # Let the worker flush whatever is still queued before the process exits.
+        try:
+            log_q.put(None, timeout=5)
+        except queue.Full:
+            return
+        worker.join(timeout=5)
+
+    atexit.register(_stop)
+
+def invalidate_history():
+    """Drop the cached /admin/history page after an admin change is committed."""
+    cache.delete(HISTORY_CACHE_KEY)
 
 # ----------------------
 # Public routes
 # ----------------------
+# Characters of post content fetched for the homepage preview line.
+PREVIEW_CHARS = 200
+
+def homepage_posts_query():
+    """Non-archived posts, newest first, as plain rows for the homepage listing."""
+    # Plain rows rather than ORM objects: the template only reads these columns.
+    # The one-line preview never shows more than a prefix, so don't fetch whole bodies.
+    return (
+        db.select(
+            Post.id,
+            Post.title,
+            db.func.substr(Post.content, 1, PREVIEW_CHARS).label('content'),
+            Post.created_at,
+        )
+        .where(Post.is_archived.is_(False))
+        .order_by(Post.created_at.desc(), Post.id.desc())
+    )
+
 @bp.route('/')
 def index():
     # Public view: only non-archived posts, newest first.
-    posts = Post.query.filter_by(is_archived=False).order_by(Post.created_at.desc()).all()
+    posts = db.session.execute(homepage_posts_query()).all()
     return render_template('index.html', posts=posts)
 
 @bp.route('/posts/<int:post_id>')
 def view_post(post_id):
-    post = Post.query.get_or_404(post_id)
+    post = db.get_or_404(Post, post_id)
     if post.is_archived:
         abort(404)
     return render_template('post_form.html', post=post, readonly=True)
@@ -126,7 +298,10 @@ def view_post(post_id):
 @bp.route('/admin')
 def admin_home():
     # Show all posts including archived
-    posts = Post.query.order_by(Post.created_at.desc()).all()
+    posts = db.session.execute(
+        db.select(Post.id, Post.title, Post.is_archived, Post.created_at, Post.updated_at)
+        .order_by(Post.created_at.desc(), Post.id.desc())
+    ).all()
     return render_template('admin.html', posts=posts)
 
 @bp.route('/admin/posts/new', methods=['GET', 'POST'])
@@ -139,15 +314,17 @@ def admin_create_post():
             return redirect(url_for('main.admin_create_post'))
         post = Post(title=title, content=content)
         db.session.add(post)
-        db.session.commit()
+        db.session.flush()  # assign post.id for the audit entry
         log_action('CREATE', post, note=f'Created post "{post.title}"')
+        db.session.commit()
+        invalidate_history()
         flash('Post created.', 'success')
         return redirect(url_for('main.admin_home'))
     return render_template('post_form.html', post=None, readonly=False)
 
 @bp.route('/admin/posts/<int:post_id>/edit', methods=['GET', 'POST'])
 def admin_edit_post(post_id):
-    post = Post.query.get_or_404(post_id)
+    post = db.get_or_404(Post, post_id)
     if request.method == 'POST':
         old_title, old_content = post.title, post.content
         post.title = request.form.get('title', '').strip()
@@ -155,110 +332,211 @@ def admin_edit_post(post_id):
         if not post.title or not post.content:
             flash('Title and content are required.', 'error')
             return redirect(url_for('main.admin_edit_post', post_id=post.id))
-        db.session.commit()
         log_action('UPDATE', post, note=f'Updated title from {old_title!r} to {post.title!r}')
+        db.session.commit()
+        invalidate_history()
         flash('Post updated.', 'success')
         return redirect(url_for('main.admin_home'))
     return render_template('post_form.html', post=post, readonly=False)
 
 @bp.route('/admin/posts/<int:post_id>/delete', methods=['POST'])
 def admin_delete_post(post_id):
-    post = Post.query.get_or_404(post_id)
+    post = db.get_or_404(Post, post_id)
     title = post.title
     db.session.delete(post)
-    db.session.commit()
-    # Log after deletion; post_id is None because the row is gone.
+    # post_id is None on the entry because the row is gone once this commits.
     log_action('DELETE', None, note=f'Deleted post id={post_id} title={title!r}')
+    db.session.commit()
+    invalidate_history()
     flash('Post deleted.', 'success')
     return redirect(url_for('main.admin_home'))
 
 @bp.route('/admin/posts/<int:post_id>/archive', methods=['POST'])
 def admin_archive_post(post_id):
-    post = Post.query.get_or_404(post_id)
+    post = db.get_or_404(Post, post_id)
     if not post.is_archived:
         post.is_archived = True
-        db.session.commit()
         # Record the archive event for history/auditing.
         log_action('ARCHIVE', post, note=f'Archived post "{post.title}"')
+        db.session.commit()
+        invalidate_history()
         flash('Post archived.', 'success')
     return redirect(url_for('main.admin_home'))
 
 @bp.route('/admin/posts/<int:post_id>/unarchive', methods=['POST'])
 def admin_unarchive_post(post_id):
-    post = Post.query.get_or_404(post_id)
+    post = db.get_or_404(Post, post_id)
     if post.is_archived:
         post.is_archived = False
-        db.session.commit()
         # Record the unarchive event for history/auditing.
         log_action('UNARCHIVE', post, note=f'Unarchived post "{post.title}"')
+        db.session.commit()
+        invalidate_history()
         flash('Post unarchived.', 'success')
     return redirect(url_for('main.admin_home'))
 
+# flask_caching's default key for a cached view is "view/<request.path>".
+HISTORY_CACHE_KEY = 'view//admin/history'
+
 @bp.route('/admin/history')
+@cache.cached(timeout=10)
 def admin_history():
-    logs = ActionLog.query.order_by(ActionLog.created_at.desc()).limit(200).all()
+    # The template only needs log.post_id; raiseload turns any accidental
+    # log.post access into an error instead of one extra query per row.
+    logs = (
+        ActionLog.query.options(raiseload('*'))
+        .order_by(ActionLog.created_at.desc(), ActionLog.id.desc())
+        .limit(200)
+        .all()
+    )
     return render_template('history.html', logs=logs)
 
-@bp.route("/health")
-def health():
-    """Basic health + metrics endpoint for monitoring."""
-    avg_latency = (TOTAL_LATENCY / REQUEST_TOTAL) if REQUEST_TOTAL else 0.0
-    payload = {
+def health_payload() -> dict:
+    """Current status + request metrics summary reported by /health."""
+    request_total = int(REQ_TOTAL._value.get())
+    avg_latency = (LATENCY._sum.get() / request_total) if request_total else 0.0
+    return {
         "status": "ok",
-        "request_count": REQUEST_TOTAL,
-        "error_count": ERROR_COUNT,
+        "request_count": request_total,
+        "error_count": int(ERR_TOTAL._value.get()),
         "avg_latency_ms": round(avg_latency * 1000, 2),
     }
+
+@bp.route("/health")
+def health():
+    """Basic health + metrics endpoint for monitoring.
+
+    GETs are normally answered by the health_fast_path middleware before
+    reaching Flask; this view covers anything it lets through.
+    """
     # jsonify ensures proper JSON + mimetype
-    return jsonify(payload), 200
+    return jsonify(health_payload()), 200
+
+def health_fast_path(wsgi_app):
+    """Wrap a WSGI app so GET /health skips Flask routing, hooks and jsonify.
+
+    Probes hit /health far more often than anything else, and the payload
+    only needs a few counter reads.
+    """
+    def middleware(environ, start_response):
+        if environ.get("PATH_INFO") == "/health" and environ.get("REQUEST_METHOD") == "GET":
+            body = json.dumps(health_payload(), separators=(",", ":")).encode()
+            start_response("200 OK", [
+                ("Content-Type", "application/json"),
+                ("Content-Length", str(len(body))),
+            ])
+            return [body]
+        return wsgi_app(environ, start_response)
+    return middleware
+
+# ----------------------
+# Schema upgrades
+# ----------------------
+def rebuild_tables_missing_defaults() -> list[str]:
+    """Rebuild tables created before their columns had DB-side defaults.
+
+    Older blog.db files have created_at/updated_at as NOT NULL with no
+    default, which makes inserts fail now that the database fills them in.
+    SQLite can't ALTER a column default, so affected tables are recreated
+    from the current model and their rows copied across. Indexes go with the
+    old table; init-db recreates them afterwards. Returns the rebuilt tables.
+    """
+    rebuilt = []
+    with db.engine.begin() as conn:
+        for table in (Post.__table__, ActionLog.__table__):
+            info = conn.exec_driver_sql(f"PRAGMA table_info({table.name})").all()
+            if not info:
+                continue  # table doesn't exist yet; create_all() handles it
+            db_defaults = {row[1]: row[4] for row in info}
+            needs_default = [c.name for c in table.columns if c.server_default is not None]
+            if all(db_defaults.get(name) is not None for name in needs_default):
+                continue
+            # SQLite's recommended rebuild: create new, copy, drop old, rename new.
+            tmp_name = f"_{table.name}_rebuild"
+            ddl = str(CreateTable(table).compile(db.engine)).replace(
+                f"CREATE TABLE {table.name} ", f"CREATE TABLE {tmp_name} ", 1)
+            columns = ", ".join(c.name for c in table.columns if c.name in db_defaults)
+            conn.exec_driver_sql(f"DROP TABLE IF EXISTS {tmp_name}")
+            conn.exec_driver_sql(ddl)
+            conn.exec_driver_sql(
+                f"INSERT INTO {tmp_name} ({columns}) SELECT {columns} FROM {table.name}")
+            conn.exec_driver_sql(f"DROP TABLE {table.name}")
+            conn.exec_driver_sql(f"ALTER TABLE {tmp_name} RENAME TO {table.name}")
+            rebuilt.append(table.name)
+    return rebuilt
 
 def create_app(test_config=None):
     app = Flask(__name__)
+    # Reuse compiled templates across worker restarts instead of re-parsing them.
+    # (Template auto-reload is already off outside debug mode.)
+    os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+    app.jinja_env.bytecode_cache = jinja2.FileSystemBytecodeCache(JINJA_CACHE_DIR)
     app.config.from_object(Config)
     if test_config:
         app.config.update(test_config)
     
     db.init_app(app)
-
-    @app.before_request
-    def before_request_metrics():
-        REQUEST_COUNT.labels(endpoint=request.path).inc()
+    cache.init_app(app)
+    if app.config["ACTION_LOG_ASYNC"]:
+        _start_action_log_worker(app)
 
     # ---- metrics hooks ----
+    # Route rule -> bound REQUEST_COUNT child, filled in once the routes are registered.
+    endpoint_counters = {}
+
     @app.before_request
-    def _start_timer():
+    def before_request_metrics():
+        if request.path in MONITORING_PATHS:
+            return
         g._start_time = perf_counter()
+        # Label by route rule, not raw path, so /posts/<id> stays one series.
+        rule = request.url_rule
+        endpoint = rule.rule if rule else "unmatched"
+        counter = endpoint_counters.get(endpoint)
+        if counter is None:
+            # Routes added after create_app() returns are bound on first use.
+            counter = endpoint_counters[endpoint] = REQUEST_COUNT.labels(endpoint=endpoint)
+        counter.inc()
 
     @app.after_request
     def _record_metrics(response):
-        global REQUEST_TOTAL, TOTAL_LATENCY
-        REQUEST_TOTAL += 1
         start = getattr(g, "_start_time", None)
-        if start is not None:
-            TOTAL_LATENCY += perf_counter() - start
+        if start is None:
+            return response
+        REQ_TOTAL.inc()
+        LATENCY.observe(perf_counter() - start)
         return response
     
     @app.teardown_request
     def _count_errors(exc):
-        global ERROR_COUNT
-        if exc is not None:
-            ERROR_COUNT += 1
+        if exc is not None and request.path not in MONITORING_PATHS:
+            ERR_TOTAL.inc()
 
     # register blueprint
     app.register_blueprint(bp)
-
-    # ensure tables exist on first run (safe if they already exist)
+    app.wsgi_app = health_fast_path(app.wsgi_app)
+    endpoint_counters.update(
+        (r.rule, REQUEST_COUNT.labels(endpoint=r.rule))
+        for r in app.url_map.iter_rules()
+        if r.rule not in MONITORING_PATHS
+    )
+    endpoint_counters["unmatched"] = REQUEST_COUNT.labels(endpoint="unmatched")
+
+    # ensure tables exist on first run (create_all skips tables that already exist)
     with app.app_context():
-        existing = set(inspect(db.engine).get_table_names())
-        needed = {"posts", "action_logs"}
-        if not needed.issubset(existing):
-            db.create_all()
+        db.create_all()
 
     # CLI helper to init the DB
     @app.cli.command("init-db")
     def init_db_cmd():
-        """Initialize database tables (safe to run multiple times)."""
+        """Initialize/upgrade database tables and indexes (safe to run multiple times)."""
         db.create_all()
+        for name in rebuild_tables_missing_defaults():
+            print("Rebuilt table", name, "with database-side timestamp defaults")
+        # create_all() skips indexes on tables that already exist, so add them explicitly.
+        for model in (Post, ActionLog):
+            for index in model.__table__.indexes:
+                index.create(db.engine, checkfirst=True)
         print("Database initialized at", DB_PATH)
 
     return app
@@ -266,9 +544,26 @@ def create_app(test_config=None):
 # Expose a global WSGI app for Azure and other WSGI servers
 app = create_app()
 
+# Scrapes within this window get the same exposition instead of re-walking the registry.
+METRICS_TTL = 1.0
+_metrics_cache: tuple[float, bytes, bytes] = (float("-inf"), b"", b"")
+
 @app.route("/metrics")
 def metrics():
-    return generate_latest(), 200, {"Content-Type": "text/plain"}
+    global _metrics_cache
+    generated_at, body, body_gz = _metrics_cache
+    now = perf_counter()
+    if now - generated_at >= METRICS_TTL:
+        body = generate_latest()
+        body_gz = gzip.compress(body, compresslevel=1)
+        _metrics_cache = (now, body, body_gz)
+    headers = {"Content-Type": "text/plain", "Vary": "Accept-Encoding"}
+    # Prometheus sends Accept-Encoding: gzip; plain clients (curl, browsers without it) get text.
+    if request.accept_encodings["gzip"] > 0:
+        body = body_gz
+        headers["Content-Encoding"] = "gzip"
+    headers["Content-Length"] = str(len(body))
+    return body, 200, headers
 
 if __name__ == "__main__":
     # Local development entrypoint
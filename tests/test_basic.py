@@ -1,14 +1,29 @@
 # tests/test_admin.py
 import os, sys; sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 import pytest
-from app import create_app
+from sqlalchemy.pool import StaticPool
+from app import create_app, db, cache
 
-@pytest.fixture
-def client():
-    app = create_app({
+@pytest.fixture(scope="module")
+def app():
+    # One in-memory DB per module: StaticPool keeps the single connection (and its
+    # tables) alive, so the schema is created once instead of per test.
+    return create_app({
         "TESTING": True,
         "SQLALCHEMY_DATABASE_URI": "sqlite:///:memory:",
+        "SQLALCHEMY_ENGINE_OPTIONS": {"poolclass": StaticPool, "connect_args": {"check_same_thread": False}},
+        # Write audit entries inline so tests can assert on them right away.
+        "ACTION_LOG_ASYNC": False,
     })
+
+@pytest.fixture
+def client(app):
+    # Start every test from empty tables (ids restart at 1) and a cold cache.
+    with app.app_context():
+        for table in reversed(db.metadata.sorted_tables):
+            db.session.execute(table.delete())
+        db.session.commit()
+        cache.clear()
     with app.test_client() as c:
         yield c
 
@@ -65,4 +80,158 @@ def test_health_endpoint(client):
     # Should at least have these keys
     assert "request_count" in data
     assert "error_count" in data
-    assert "avg_latency_ms" in data
\ No newline at end of file
+    assert "avg_latency_ms" in data
+
+def test_homepage_query_uses_index(client):
+    """Public listing should be served by the composite index, not a table scan"""
+    from app import homepage_posts_query
+    with client.application.app_context():
+        sql = homepage_posts_query().compile(db.engine, compile_kwargs={"literal_binds": True})
+        plan = db.session.execute(db.text(f"EXPLAIN QUERY PLAN {sql}")).all()
+    assert any("ix_posts_archived_created" in row[-1] for row in plan)
+
+def test_create_post_is_logged(client):
+    """Creating a post should record a CREATE entry linked to the new post"""
+    client.post("/admin/posts/new", data={"title": "Logged", "content": "Body"})
+    r = client.get("/admin/history")
+    assert r.status_code == 200
+    assert b"CREATE" in r.data
+    assert b"on post #1" in r.data
+
+def test_history_cache_invalidated_on_change(client):
+    """A cached history page should pick up new admin actions immediately"""
+    assert b"No history yet." in client.get("/admin/history").data
+    client.post("/admin/posts/new", data={"title": "Fresh", "content": "Body"})
+    assert b"CREATE" in client.get("/admin/history").data
+
+def test_archived_post_hidden_from_homepage(client):
+    """Archived posts stay on the admin list but drop off the public listing"""
+    client.post("/admin/posts/new", data={"title": "Hidden", "content": "Body"})
+    assert b"Hidden" in client.get("/").data
+    client.post("/admin/posts/1/archive")
+    assert b"Hidden" not in client.get("/").data
+    assert b"Archived" in client.get("/admin").data
+
+def test_monitoring_endpoints_not_counted(client):
+    """Polling /health and /metrics should not inflate the request count"""
+    before = client.get("/health").get_json()["request_count"]
+    client.get("/metrics")
+    client.get("/health")
+    assert client.get("/health").get_json()["request_count"] == before
+    client.get("/")
+    assert client.get("/health").get_json()["request_count"] == before + 1
+
+def test_request_count_labelled_by_route(client):
+    """Per-endpoint counter should use the route rule, not the concrete URL"""
+    from prometheus_client import generate_latest
+    client.get("/posts/12345")
+    body = generate_latest()
+    assert b'endpoint="/posts/<int:post_id>"' in body
+    assert b'endpoint="/posts/12345"' not in body
+
+def _async_app(tmp_path):
+    return create_app({
+        "TESTING": True,
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'async.db'}",
+        "ACTION_LOG_ASYNC": True,
+    })
+
+def _stop_writer(app):
+    # Flush and stop the background writer, as happens at interpreter exit.
+    log_q, worker = app.extensions["action_log_writer"]
+    log_q.put(None)
+    worker.join(timeout=5)
+
+def test_async_action_log_written_in_background(tmp_path):
+    """With the background writer on, audit entries still reach the DB"""
+    import time
+    app = _async_app(tmp_path)
+    c = app.test_client()
+    c.post("/admin/posts/new", data={"title": "Queued", "content": "Body"})
+    for _ in range(50):
+        if b"CREATE" in c.get("/admin/history").data:
+            break
+        time.sleep(0.05)
+    else:
+        pytest.fail("action log entry was never written")
+
+def test_async_action_log_dropped_when_commit_fails(tmp_path):
+    """A queued audit entry must not outlive a failed commit"""
+    from sqlalchemy.exc import IntegrityError
+    from app import ActionLog, Post, log_action
+    app = _async_app(tmp_path)
+    with app.test_request_context():
+        post = Post(title="Doomed", content="Body")
+        db.session.add(post)
+        db.session.flush()
+        log_action("CREATE", post)
+        db.session.add(Post(title=None, content="violates NOT NULL"))
+        with pytest.raises(IntegrityError):
+            db.session.commit()
+        db.session.rollback()
+    _stop_writer(app)
+    with app.app_context():
+        assert db.session.query(ActionLog).count() == 0
+
+def test_action_log_written_inline_without_live_writer(tmp_path):
+    """If the writer thread is gone (e.g. after a fork), entries are written inline"""
+    app = _async_app(tmp_path)
+    _stop_writer(app)
+    c = app.test_client()
+    c.post("/admin/posts/new", data={"title": "Inline", "content": "Body"})
+    assert b"CREATE" in c.get("/admin/history").data
+
+def test_metrics_gzipped_for_prometheus():
+    """/metrics serves gzip to clients that accept it and plain text otherwise"""
+    import gzip
+    from app import app as wsgi_app
+    c = wsgi_app.test_client()
+    plain = c.get("/metrics")
+    assert b"request_count_total" in plain.data
+    assert "Content-Encoding" not in plain.headers
+    zipped = c.get("/metrics", headers={"Accept-Encoding": "gzip"})
+    assert zipped.headers["Content-Encoding"] == "gzip"
+    assert int(zipped.headers["Content-Length"]) == len(zipped.data)
+    assert b"request_count_total" in gzip.decompress(zipped.data)
+    refused = c.get("/metrics", headers={"Accept-Encoding": "gzip;q=0"})
+    assert "Content-Encoding" not in refused.headers
+    assert b"request_count_total" in refused.data
+
+def test_homepage_preview_is_truncated(client):
+    """Homepage only ships a prefix of long posts; the full text is on the post page"""
+    content = "x" * 150 + "TAIL" + "y" * 5000
+    client.post("/admin/posts/new", data={"title": "Long", "content": content})
+    assert b"TAIL" in client.get("/").data
+    assert b"y" * 1000 not in client.get("/").data
+    assert content.encode() in client.get("/posts/1").data
+
+def test_init_db_upgrades_tables_without_timestamp_defaults(tmp_path):
+    """init-db rebuilds pre-existing tables so inserts get DB-side timestamps"""
+    import sqlite3
+    path = tmp_path / "old.db"
+    con = sqlite3.connect(path)
+    con.executescript("""
+        CREATE TABLE posts (id INTEGER NOT NULL PRIMARY KEY, title VARCHAR(200) NOT NULL,
+            content TEXT NOT NULL, is_archived BOOLEAN NOT NULL,
+            created_at DATETIME NOT NULL, updated_at DATETIME NOT NULL);
+        CREATE TABLE action_logs (id INTEGER NOT NULL PRIMARY KEY, action VARCHAR(100) NOT NULL,
+            post_id INTEGER REFERENCES posts (id), note TEXT, created_at DATETIME NOT NULL);
+        INSERT INTO posts VALUES (1, 'Old', 'Body', 0, '2024-01-01 00:00:00', '2024-01-01 00:00:00');
+        INSERT INTO action_logs VALUES (1, 'CREATE', 1, 'Created post "Old"', '2024-01-01 00:00:00');
+    """)
+    con.close()
+    app = create_app({
+        "TESTING": True,
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{path}",
+        "ACTION_LOG_ASYNC": False,
+    })
+    result = app.test_cli_runner().invoke(args=["init-db"])
+    assert "Rebuilt table posts" in result.output
+    assert "Rebuilt table action_logs" in result.output
+    c = app.test_client()
+    c.post("/admin/posts/new", data={"title": "New", "content": "Body"})
+    body = c.get("/admin").data
+    assert b"Old" in body and b"New" in body
+    assert c.get("/admin/history").data.count(b"CREATE") == 2
+    # Second run is a no-op.
+    assert "Rebuilt" not in app.test_cli_runner().invoke(args=["init-db"]).output